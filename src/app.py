@@ -3,7 +3,9 @@ import textwrap
 import streamlit as st
 
 from chatclient import ChatClient
-from html_formatting import PROMPT_CSS, RESPONSE_CSS, add_html_wrapping
+from html_formatting import (PROMPT_CSS, RESPONSE_CSS, add_html_wrapping, field_agreement_table,
+                             field_error_heatmap)
+from voting import format_path
 
 # app states
 image_name = 'form2.jpg'
@@ -16,10 +18,15 @@ if 'is_first_prompt' not in st.session_state:
 # setup app page
 st.set_page_config(layout="wide")
 st.markdown("<h1 style='text-align: center;'>Prompt Iteration</h1>", unsafe_allow_html=True)
+# more than 1: send concurrent calls with different seeds and merge them by majority vote,
+# odd so that two values cannot split the vote evenly
+samples = st.sidebar.number_input('Samples per prompt', min_value=1, max_value=9, value=1, step=2)
 
 left, right = st.columns(2)
 left.subheader('Previous', divider='gray')
 right.subheader('Current', divider='gray')
+# pick which two iterations to compare, filled in once there are responses
+version_select1, version_select2 = left.empty(), right.empty()
 
 # prompt section
 st.subheader("Prompt")
@@ -32,10 +39,14 @@ with space_between_prompt_response:
 
 # response section
 st.subheader("Response")
+# large responses: only send the differing parts to the browser, unchanged parts load on demand
+only_differences = st.toggle('Only show differences')
 response_col1, response_col2 = st.columns(2)
 # displays "response is not a valid JSON" warnings
 json_warning1, json_warning2 = response_col1.empty(), response_col2.empty()
+sampling_display = st.empty()
 analysis = st.empty()
+field_error_display = st.empty()
 
 # chat section
 response_display = st.empty()
@@ -43,45 +54,114 @@ prompt = st.chat_input('Enter your prompt')
 
 # this runs every time user presses enter
 if prompt:
-    chat_client.send_task_message(prompt, st.session_state.is_first_prompt)
-
-    if st.session_state.is_first_prompt:  # no need to compare
-        with prompt_col2:
-            html_code = add_html_wrapping(
-                textwrap.fill(chat_client.cur_prompt, width=35),
-                PROMPT_CSS,
-                'prompt-block')
-            st.markdown(html_code, unsafe_allow_html=True)
-        with response_col2:
-            html_code = add_html_wrapping(
-                chat_client.cur_response,
-                RESPONSE_CSS,
-                'response-block')
-            st.markdown(html_code, unsafe_allow_html=True)
-        if not isinstance(chat_client.cur_response, dict):
-            json_warning2.warning('This response does not contain a valid JSON')
+    if samples > 1:
+        chat_client.send_sampled_task_message(prompt, st.session_state.is_first_prompt, samples)
     else:
-        # display prompt comparison
-        chat_client.compare_display_prompts(prompt_col1, prompt_col2)
-        # response comparison
-        chat_client.compare_display_responses(response_col1, response_col2,
-                                              json_warning1, json_warning2)
+        chat_client.send_task_message(prompt, st.session_state.is_first_prompt)
+    if chat_client.cur_accuracy < 100:
+        chat_client.send_analyze_message(st.session_state.is_first_prompt)
+    st.session_state.is_first_prompt = False
+
+# automatic refinement of the current prompt, after sending so a new prompt can be refined right away
+st.sidebar.subheader('Automatic refinement')
+refine_rounds = st.sidebar.number_input('Rounds', min_value=1, max_value=20, value=5)
+refine_candidates = st.sidebar.number_input('Candidates per round', min_value=1, max_value=8, value=3)
+refine_max_calls = st.sidebar.number_input('Call budget', min_value=1, value=40)
+refine_max_tokens = st.sidebar.number_input('Token budget', min_value=1, value=200_000, step=10_000)
+refine = st.sidebar.button('Refine current prompt', disabled=not chat_client.iterations)
+refine_report = st.sidebar.empty()
+
+if refine:
+    with st.spinner('Refining prompt...'):
+        st.session_state.refine_report = chat_client.refine_prompt(
+            chat_client.cur_prompt, refine_rounds, refine_candidates,
+            refine_max_calls, refine_max_tokens)
+if 'refine_report' in st.session_state:
+    report = st.session_state.refine_report
+    with refine_report.container():
+        st.write(f"Best accuracy {report['best_accuracy']}% after {report['calls']} calls "
+                 f"and {report['tokens']} tokens, stopped by {report['stop_reason']}")
+        st.table(report['rounds'])
+        st.write('Best prompt:')
+        st.code(report['best_prompt'], language=None)
+
+iterations = chat_client.iterations
 
-    if chat_client.prev_accuracy and chat_client.prev_accuracy == -1:
+
+def display_sampling(sampling):
+    """voting summary and per-field agreement of a sampled iteration"""
+    if not sampling:
+        return
+    with sampling_display.container():
+        st.write(f"Majority vote over {sampling['samples']} samples "
+                 f"({sampling['valid_samples']} valid JSONs): "
+                 f"accuracy {sampling['mean_accuracy']}% on average -> "
+                 f"{sampling['voted_accuracy']}% voted ({sampling['accuracy_gain']:+}), "
+                 f"{sampling['wall_time']:.1f}s wall clock vs. "
+                 f"{sampling['mean_call_time']:.1f}s per call")
+        with st.expander('Field agreement'):
+            agreement = {format_path(path): rate for path, rate in sampling['agreement'].items()}
+            presence = {format_path(path): rate for path, rate in sampling['presence'].items()}
+            st.markdown(field_agreement_table(agreement, presence), unsafe_allow_html=True)
+
+
+if len(iterations) == 1:  # no need to compare
+    with prompt_col2:
+        html_code = add_html_wrapping(
+            textwrap.fill(iterations[0]['prompt'], width=35),
+            PROMPT_CSS,
+            'prompt-block')
+        st.markdown(html_code, unsafe_allow_html=True)
+    with response_col2:
+        html_code = add_html_wrapping(
+            iterations[0]['response'],
+            RESPONSE_CSS,
+            'response-block')
+        st.markdown(html_code, unsafe_allow_html=True)
+    if not isinstance(iterations[0]['response'], dict):
+        json_warning2.warning('This response does not contain a valid JSON')
+    with response_col2:
+        st.write(f"Accuracy: {max(iterations[0]['accuracy'], 0)}%")
+    display_sampling(iterations[0]['sampling'])
+    if iterations[0]['analysis']:
+        analysis.write(iterations[0]['analysis'])
+elif len(iterations) > 1:
+    # options are rebuilt when a new iteration arrives, which resets the
+    # selection to the two most recent versions
+    versions = list(range(len(iterations)))
+    version1 = version_select1.selectbox('Previous version', versions, index=len(iterations) - 2,
+                                         format_func=lambda i: f'Iteration {i + 1}')
+    version2 = version_select2.selectbox('Current version', versions, index=len(iterations) - 1,
+                                         format_func=lambda i: f'Iteration {i + 1}')
+
+    # display prompt comparison
+    chat_client.compare_display_prompts(prompt_col1, prompt_col2, version1, version2)
+    # response comparison
+    chat_client.compare_display_responses(response_col1, response_col2,
+                                          json_warning1, json_warning2,
+                                          version1, version2, only_differences)
+
+    accuracy1 = iterations[version1]['accuracy']
+    accuracy2 = iterations[version2]['accuracy']
+    if accuracy1 == -1:
         json_warning1.warning('This response does not contain a valid JSON')
-    if chat_client.cur_accuracy and chat_client.cur_accuracy == -1:
+    if accuracy2 == -1:
         json_warning2.warning('This response does not contain a valid JSON')
     # accuracy
     with response_col1:
-        st.write(f'Accuracy: {max(chat_client.prev_accuracy, 0)}%')
+        st.write(f'Accuracy: {max(accuracy1, 0)}%')
     with response_col2:
-        st.write(f'Accuracy: {max(chat_client.cur_accuracy, 0)}%')
+        st.write(f'Accuracy: {max(accuracy2, 0)}%')
 
-    if chat_client.cur_accuracy < 100:
-        analysis.write(chat_client.send_analyze_message(st.session_state.is_first_prompt))
-    st.session_state.is_first_prompt = False
+    display_sampling(iterations[version2]['sampling'])
+    if iterations[version2]['analysis']:
+        analysis.write(iterations[version2]['analysis'])
 
+if chat_client.field_errors.counts:
+    with field_error_display.expander('Field error rates'):
+        st.markdown(field_error_heatmap(chat_client.field_errors.rates()), unsafe_allow_html=True)
+
+if iterations:
     # placeholder space no longer needed after there are responses
     with space_between_prompt_response:
         st.write("")
-
@@ -1,15 +1,23 @@
+from concurrent.futures import ThreadPoolExecutor
+import functools
 from http import HTTPStatus
+import json
 import os
 import sys
+import time
 
 import dashscope
 from dashscope import MultiModalConversation
 from dotenv import load_dotenv
 
-from messages import json_analysis_prompt
+from field_errors import FieldErrorAggregator
+from messages import (REFINED_PROMPT_END, REFINED_PROMPT_START, json_analysis_prompt,
+                      prompt_refinement_prompt)
 from right_answer import RIGHT_ANSWER
-from comparing import (character_level_compare_and_display, get_json_diffs,
-                       json_compare_and_display, json_accuracy_score,
+from voting import majority_vote
+from comparing import (character_level_diff, display_character_level_diff,
+                       display_collapsed_json_diff, display_json_diff, get_json_diffs,
+                       json_diff, json_diff_collapsed, json_accuracy_score,
                        load_json_string)
 
 __all__ = ['ChatClient']
@@ -18,6 +26,18 @@ __all__ = ['ChatClient']
 # private globals
 # -----------------------------------------------------------------------------
 _QWEN_MODEL = 'qwen-vl-max'
+_SEED = 1024
+
+# automatic prompt refinement defaults
+_REFINE_ROUNDS = 5
+_REFINE_CANDIDATES = 3
+_REFINE_MAX_CALLS = 40
+_REFINE_MAX_TOKENS = 200_000
+# stop after this many rounds without an accuracy gain of more than _REFINE_MIN_GAIN
+_REFINE_PATIENCE = 2
+_REFINE_MIN_GAIN = 0.5
+# number of (version, version) comparisons kept in memory
+_DIFF_CACHE_SIZE = 32
 
 
 def _get_project_root() -> str:
@@ -54,6 +74,58 @@ def _extract_json(full_response):
     return full_response[content_start:end].strip()
 
 
+def _extract_prompt(full_response):
+    """
+    the rewritten prompt is between the first REFINED_PROMPT_START and the last REFINED_PROMPT_END,
+    returns the whole response if either is missing
+    """
+    start = full_response.find(REFINED_PROMPT_START)
+    end = full_response.rfind(REFINED_PROMPT_END)
+    if start == -1 or end < start:
+        return full_response.strip()
+    return full_response[start + len(REFINED_PROMPT_START):end].strip()
+
+
+def _call(messages, seed=_SEED):
+    """
+    :return:
+        None if HTTP error,
+        qwen response otherwise
+    """
+    response = MultiModalConversation.call(
+        model=_QWEN_MODEL,
+        messages=messages,
+        seed=seed,
+        top_p=0.3,
+    )
+    if response.status_code != HTTPStatus.OK:
+        return None
+    return response
+
+
+def _timed_text(messages, seed=_SEED):
+    """
+    :return: (text in response or None if HTTP error, seconds taken, tokens used)
+    """
+    start = time.perf_counter()
+    response = _call(messages, seed)
+    elapsed = time.perf_counter() - start
+    if response is None:
+        return None, elapsed, 0
+    tokens = response.usage.input_tokens + response.usage.output_tokens
+    return _get_text(response), elapsed, tokens
+
+
+def _run_concurrently(jobs):
+    """
+    :param jobs: list of (messages, seed)
+    :return: list of _timed_text results, in the same order
+    """
+    # the calls only wait on the network, so threads run them side by side
+    with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        return list(executor.map(lambda job: _timed_text(*job), jobs))
+
+
 class ChatClient:
     """handles sending to and receiving from qwen"""
 
@@ -84,6 +156,35 @@ class ChatClient:
         # user given score
         self.prev_score = self.cur_score = 0
 
+        # every prompt/response pair, in order, so that any two versions can be compared
+        # each entry: {'prompt': str, 'response': dict or str, 'accuracy': float, 'analysis': str,
+        #              'sampling': sampling report if sent with send_sampled_task_message, else None}
+        self.iterations = []
+        # diffs are computed on demand and kept in bounded LRUs keyed by (version, version),
+        # prompts and responses separately so that each is only computed in the form displayed
+        self._cached_prompt_diff = functools.lru_cache(maxsize=_DIFF_CACHE_SIZE)(self._prompt_diff)
+        self._cached_response_diff = functools.lru_cache(maxsize=_DIFF_CACHE_SIZE)(
+            self._response_diff)
+
+        # running per-field missing/wrong counts over every response
+        self.field_errors = FieldErrorAggregator(self.right_answer)
+
+    def _user_message(self, msg):
+        """user message with the image attached"""
+        return {'role': 'user',
+                'content': [
+                    {'text': msg},
+                    {'image': self.qwen_file_path}
+                ]}
+
+    def _assistant_message(self, response):
+        """assistant message for a response not received through _send_message"""
+        if isinstance(response, dict):
+            text = f"```json\n{json.dumps(response, indent=2, ensure_ascii=False)}\n```"
+        else:
+            text = response or ''
+        return {'role': 'assistant', 'content': [{'text': text}]}
+
     def _send_message(self, msg, is_first_message):
         """
         :param msg: message to send to model
@@ -93,33 +194,16 @@ class ChatClient:
             text in response otherwise
         """
         if is_first_message:
-            self.messages = [
-                {
-                    'role': 'user',
-                    'content': [
-                        {'text': msg},
-                        {'image': self.qwen_file_path}
-                    ]
-                }
-            ]
+            self.messages = [self._user_message(msg)]
         else:
-            self.messages.append({"role": "user",
-                                  "content": [
-                                      {"text": msg},
-                                      {'image': self.qwen_file_path}
-                                  ]})
+            self.messages.append(self._user_message(msg))
 
         # for testing: display chat history
         import streamlit as st
         st.write(len(self.messages), self.messages)
-        response = MultiModalConversation.call(
-            model=_QWEN_MODEL,
-            messages=self.messages,
-            seed=1024,
-            top_p=0.3,
-        )
-
-        if response.status_code != HTTPStatus.OK:
+        response = _call(self.messages)
+
+        if response is None:
             return None
 
         # save response to chat history
@@ -129,25 +213,76 @@ class ChatClient:
         processed_response = _get_text(response)
         return processed_response
 
+    def _load_response(self, processed_response):
+        """in JSON mode, convert the response text to a dict if it contains a valid JSON"""
+        if self.mode == 'JSON' and processed_response:
+            loaded_json = load_json_string(_extract_json(processed_response))
+            if loaded_json:
+                return loaded_json
+        return processed_response
+
+    def _record_iteration(self, msg, response, sampling=None):
+        """update saved prompts/responses/accuracy with a new iteration"""
+        self.prev_prompt, self.cur_prompt = self.cur_prompt, msg
+        self.prev_response, self.cur_response = self.cur_response, response
+        self.prev_accuracy = self.cur_accuracy
+        self.cur_accuracy = json_accuracy_score(self.cur_response, self.right_answer)
+        self.field_errors.add(get_json_diffs(self.cur_response, self.right_answer))
+
+        self.iterations.append({'prompt': self.cur_prompt,
+                                'response': self.cur_response,
+                                'accuracy': self.cur_accuracy,
+                                'analysis': None,
+                                'sampling': sampling})
+
     def send_task_message(self, msg, is_first_prompt):
         """send user's task to model"""
-        # update saved prompts
-        self.prev_prompt = self.cur_prompt
-        self.cur_prompt = msg
-
         # send message to qwen
         processed_response = self._send_message(msg, is_first_prompt)
+        self._record_iteration(msg, self._load_response(processed_response))
 
-        if self.mode == 'JSON':
-            print('processed response: ', _extract_json(processed_response))
-            print('loaded json: ', load_json_string(_extract_json(processed_response)))
-            loaded_json = load_json_string(_extract_json(processed_response))
-            if loaded_json:
-                processed_response = loaded_json
+    def send_sampled_task_message(self, msg, is_first_prompt, samples):
+        """
+        send user's task to model concurrently with different seeds,
+        and merge the JSON responses by per-field majority vote (see majority_vote)
 
-        self.prev_response, self.cur_response = self.cur_response, processed_response
-        self.prev_accuracy = self.prev_accuracy
-        self.cur_accuracy = json_accuracy_score(self.cur_response, self.right_answer)
+        :param samples: number of calls, odd and at least 3 so that two values cannot tie
+        :return: sampling report, also saved in the iteration as 'sampling'
+        """
+        if samples < 3 or samples % 2 == 0:
+            raise ValueError(f'samples must be odd and at least 3, got {samples}')
+        messages = ([] if is_first_prompt else self.messages) + [self._user_message(msg)]
+
+        start = time.perf_counter()
+        results = _run_concurrently([(messages, seed) for seed in range(_SEED, _SEED + samples)])
+        wall_time = time.perf_counter() - start
+
+        responses = [self._load_response(text) for text, _, _ in results]
+        voted, agreement, presence = majority_vote(responses)
+        # fall back to the first sample if none contains a valid JSON
+        response = voted if voted is not None else responses[0]
+
+        # save the merged response to chat history
+        self.messages = messages + [self._assistant_message(response)]
+
+        sample_accuracies = [max(json_accuracy_score(sample, self.right_answer), 0)
+                             for sample in responses]
+        mean_accuracy = round(sum(sample_accuracies) / samples, 1)
+        voted_accuracy = max(json_accuracy_score(response, self.right_answer), 0)
+        sampling = {
+            'samples': samples,
+            'valid_samples': sum(isinstance(sample, dict) for sample in responses),
+            'agreement': agreement,
+            'presence': presence,
+            'sample_accuracies': sample_accuracies,
+            'mean_accuracy': mean_accuracy,
+            'voted_accuracy': voted_accuracy,
+            'accuracy_gain': round(voted_accuracy - mean_accuracy, 1),
+            'wall_time': wall_time,
+            'mean_call_time': sum(elapsed for _, elapsed, _ in results) / samples,
+        }
+        self._record_iteration(msg, response, sampling)
+        return sampling
 
     def send_analyze_message(self, is_first_prompt):
         """
@@ -158,21 +293,183 @@ class ChatClient:
 
         diffs = get_json_diffs(self.cur_response, self.right_answer)
         msg = json_analysis_prompt(self.cur_prompt, self.cur_accuracy, diffs,
-                                   self.cur_response, is_first_prompt)
+                                   self.cur_response, is_first_prompt, self.field_errors)
 
         processed_response = self._send_message(msg, False)
+        if self.iterations:
+            self.iterations[-1]['analysis'] = processed_response
         return processed_response
 
-    def compare_display_prompts(self, col1, col2):
-        character_level_compare_and_display(self.prev_prompt, self.cur_prompt, col1, col2)
+    def _evaluate_prompts(self, prompts):
+        """
+        send each prompt in a fresh conversation with the image, concurrently
+
+        :return: (list of (response, accuracy), tokens used)
+        """
+        results = _run_concurrently([([self._user_message(prompt)], _SEED) for prompt in prompts])
+        responses = [self._load_response(text) for text, _, _ in results]
+        scored = [(response, max(json_accuracy_score(response, self.right_answer), 0))
+                  for response in responses]
+        return scored, sum(tokens for _, _, tokens in results)
+
+    def refine_prompt(self, prompt, rounds=_REFINE_ROUNDS, candidates=_REFINE_CANDIDATES,
+                      max_calls=_REFINE_MAX_CALLS, max_tokens=_REFINE_MAX_TOKENS,
+                      patience=_REFINE_PATIENCE, min_gain=_REFINE_MIN_GAIN):
+        """
+        automatically improve prompt: each round analyzes the best prompt so far,
+        has the model rewrite it into several candidates following the analysis,
+        and scores the candidates (concurrently) with json_accuracy_score
+
+        the starting prompt is scored again the same way as the candidates (a single call in a
+        fresh conversation), so all scores are comparable
+
+        candidates are not saved as iterations, if a better prompt is found,
+        it is saved as the newest iteration so the app can compare it with the starting prompt,
+        and the chat history restarts from it
+
+        :param rounds: maximum number of rounds
+        :param candidates: prompts generated and scored per round
+        :param max_calls, max_tokens: budget, a round is only started if its estimated cost
+                                      (calls, and tokens based on the previous round, or on
+                                      scoring the starting prompt before the first round) fits
+        :param patience: stop after this many rounds without an accuracy gain of more than min_gain
+        :return: {'best_prompt', 'best_accuracy', 'calls', 'tokens', 'stop_reason',
+                  'rounds': list of {'round', 'calls', 'tokens', 'accuracy', 'best_accuracy'}}
+        """
+        # 1 analysis call, then candidates to generate and to score
+        round_calls = 1 + 2 * candidates
+        [(best_response, best_accuracy)], tokens = self._evaluate_prompts([prompt])
+        calls = 1
+        # until a round has run, estimate every call of it to cost as much as this one
+        tokens_estimate = tokens * round_calls
+        best_prompt = prompt
+        report = {'rounds': [{'round': 0, 'calls': calls, 'tokens': tokens,
+                              'accuracy': best_accuracy, 'best_accuracy': best_accuracy}]}
+
+        stop_reason = 'rounds'
+        rounds_without_gain = 0
+        for round_number in range(1, rounds + 1):
+            if best_accuracy >= 100:
+                stop_reason = 'perfect'
+                break
+            if rounds_without_gain >= patience:
+                stop_reason = 'plateau'
+                break
+            if calls + round_calls > max_calls:
+                stop_reason = 'call budget'
+                break
+            if tokens + tokens_estimate > max_tokens:
+                stop_reason = 'token budget'
+                break
+
+            # analyze the best prompt so far
+            diffs = get_json_diffs(best_response, self.right_answer)
+            msg = json_analysis_prompt(best_prompt, best_accuracy, diffs, best_response, True,
+                                       self.field_errors)
+            analysis, _, round_tokens = _timed_text([self._user_message(msg)])
+
+            # rewrite it into candidates, different seeds give different rewrites
+            msg = prompt_refinement_prompt(best_prompt, analysis or '')
+            rewrites = _run_concurrently([([self._user_message(msg)], seed)
+                                          for seed in range(_SEED, _SEED + candidates)])
+            round_tokens += sum(rewrite_tokens for _, _, rewrite_tokens in rewrites)
+            # identical rewrites (and the current best prompt) are only scored once
+            candidate_prompts = [_extract_prompt(text) for text, _, _ in rewrites if text]
+            candidate_prompts = [candidate for candidate in dict.fromkeys(candidate_prompts)
+                                 if candidate and candidate != best_prompt]
+
+            scored = []
+            if candidate_prompts:
+                scored, score_tokens = self._evaluate_prompts(candidate_prompts)
+                round_tokens += score_tokens
+            calls += 1 + len(rewrites) + len(candidate_prompts)
+            tokens += round_tokens
+            tokens_estimate = round_tokens
+
+            round_accuracy = 0
+            if scored:
+                best_index = max(range(len(scored)), key=lambda i: scored[i][1])
+                round_response, round_accuracy = scored[best_index]
+            # any improvement is kept, but only a large enough one resets the plateau count
+            if round_accuracy > best_accuracy + min_gain:
+                rounds_without_gain = 0
+            else:
+                rounds_without_gain += 1
+            if round_accuracy > best_accuracy:
+                best_prompt, best_response = candidate_prompts[best_index], round_response
+                best_accuracy = round_accuracy
+
+            report['rounds'].append({'round': round_number,
+                                     'calls': 1 + len(rewrites) + len(candidate_prompts),
+                                     'tokens': round_tokens,
+                                     'accuracy': round_accuracy,
+                                     'best_accuracy': best_accuracy})
+        else:
+            if best_accuracy >= 100:
+                stop_reason = 'perfect'
+
+        if best_prompt != self.cur_prompt:
+            self._record_iteration(best_prompt, best_response)
+            # the next prompt continues a conversation where the best prompt was sent
+            self.messages = [self._user_message(best_prompt), self._assistant_message(best_response)]
+
+        report.update(best_prompt=best_prompt, best_accuracy=best_accuracy,
+                      calls=calls, tokens=tokens, stop_reason=stop_reason)
+        return report
 
-    def compare_display_responses(self, col1, col2, warn1, warn2):
+    def _prompt_diff(self, version1, version2):
+        """diff the prompts of two iterations, only called through self._cached_prompt_diff"""
+        return character_level_diff(self.iterations[version1]['prompt'],
+                                    self.iterations[version2]['prompt'])
+
+    def _response_diff(self, version1, version2, collapsed):
+        """
+        diff the responses of two iterations, only called through self._cached_response_diff
+
+        :param collapsed: in JSON mode, keep only differences expanded (see json_diff_collapsed)
+        :return: (html1, html2), or (segments1, segments2) if collapsed
+        """
+        response1 = self.iterations[version1]['response']
+        response2 = self.iterations[version2]['response']
+        if self.mode == 'JSON' and collapsed:
+            return json_diff_collapsed(response1, response2)
         if self.mode == 'JSON':
-            json_compare_and_display(self.prev_response, self.cur_response,
-                                     col1, col2, warn1, warn2)
+            return json_diff(response1, response2)
+        return character_level_diff(response1, response2)
+
+    def _normalize_versions(self, version1, version2):
+        """normalize indices into self.iterations so -1 and len - 1 share a cache entry"""
+        versions = range(len(self.iterations))
+        return versions[version1], versions[version2]
+
+    def prompt_diff(self, version1=-2, version2=-1):
+        """
+        :param version1, version2: indices into self.iterations, negative indices allowed
+        :return: (html1, html2)
+        """
+        return self._cached_prompt_diff(*self._normalize_versions(version1, version2))
+
+    def response_diff(self, version1=-2, version2=-1, collapsed=False):
+        """
+        :param version1, version2: indices into self.iterations, negative indices allowed
+        :param collapsed: in JSON mode, keep only differences expanded (see json_diff_collapsed)
+        :return: (html1, html2), or (segments1, segments2) if collapsed
+        """
+        return self._cached_response_diff(*self._normalize_versions(version1, version2), collapsed)
+
+    def compare_display_prompts(self, col1, col2, version1=-2, version2=-1):
+        display_character_level_diff(self.prompt_diff(version1, version2), col1, col2)
+
+    def compare_display_responses(self, col1, col2, warn1, warn2, version1=-2, version2=-1,
+                                  collapsed=False):
+        diffs = self.response_diff(version1, version2, collapsed)
+        if self.mode == 'JSON' and collapsed:
+            display_collapsed_json_diff(diffs, col1, col2, warn1, warn2,
+                                        key=f'response-{version1}-{version2}')
+        elif self.mode == 'JSON':
+            display_json_diff(diffs, col1, col2, warn1, warn2)
         else:
-            character_level_compare_and_display(self.prev_response, self.cur_response,
-                                                col1, col2)
+            display_character_level_diff(diffs, col1, col2)
 
 
 def interactive_prompting():
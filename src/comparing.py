@@ -8,8 +8,10 @@ import streamlit as st
 
 from html_formatting import PROMPT_CSS, RESPONSE_CSS, add_html_wrapping
 
-__all__ = ['character_level_compare_and_display', 'path_to_keys', 'follow_path',
-           'get_json_diffs', 'json_compare_and_display', 'json_accuracy_score',
+__all__ = ['character_level_diff', 'display_character_level_diff',
+           'character_level_compare_and_display', 'path_to_keys', 'follow_path',
+           'get_json_diffs', 'json_diff', 'display_json_diff', 'json_compare_and_display',
+           'json_diff_collapsed', 'display_collapsed_json_diff', 'json_accuracy_score',
            'load_json_string']
 
 # -----------------------------------------------------------------------------
@@ -20,6 +22,11 @@ __all__ = ['character_level_compare_and_display', 'path_to_keys', 'follow_path',
 _VALUE_CHANGED = 0
 _KEY_CHANGED = 1
 
+# unchanged lines kept around each difference in collapsed rendering
+_CONTEXT_LINES = 2
+# highlighted lines contain a span with a color class
+_HIGHLIGHT_MARKER = "<span class='"
+
 
 def load_json_string(json_string):
     """
@@ -46,39 +53,55 @@ def get_json_diffs(cur_dict, target_dict):
     return DeepDiff(cur_dict, target_dict, view='tree')
 
 
-def character_level_compare_and_display(text1, text2, col1, col2):
+def character_level_diff(text1, text2):
     """
-    compare texts and display to streamlit columns
+    compare texts character by character
     :param text1, text2: Texts to compare
-    :param col1, col2: target streamlit columns
+    :return: (html1, html2) with removed parts of text1 in red and added parts of text2 in green
     """
     matcher = difflib.SequenceMatcher(None, text1, text2)
     # differences as a list of tuples (operation, start1, end1, start2, end2)
     opcodes = matcher.get_opcodes()
 
-    with col1:
-        processed_text1 = []
-        for tag, i1, i2, j1, j2 in opcodes:
-            chunk = text1[i1:i2]
-            if tag == 'equal':
-                processed_text1.append(f'<span>{chunk}</span>')
-            elif tag in ('replace', 'delete'):
-                processed_text1.append(f"<span class='red'>{chunk}</span>")
+    processed_text1 = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        chunk = text1[i1:i2]
+        if tag == 'equal':
+            processed_text1.append(f'<span>{chunk}</span>')
+        elif tag in ('replace', 'delete'):
+            processed_text1.append(f"<span class='red'>{chunk}</span>")
+
+    processed_text2 = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        chunk = text2[j1:j2]
+        if tag == 'equal':
+            processed_text2.append(f'<span>{chunk}</span>')
+        elif tag in ('replace', 'insert'):
+            processed_text2.append(f"<span class='green'>{chunk}</span>")
 
-        html_code = add_html_wrapping(''.join(processed_text1), PROMPT_CSS, 'prompt-block')
-        st.markdown(html_code, unsafe_allow_html=True)
+    return (add_html_wrapping(''.join(processed_text1), PROMPT_CSS, 'prompt-block'),
+            add_html_wrapping(''.join(processed_text2), PROMPT_CSS, 'prompt-block'))
 
+
+def display_character_level_diff(html_pair, col1, col2):
+    """
+    :param html_pair: result of character_level_diff
+    :param col1, col2: target streamlit columns
+    """
+    html1, html2 = html_pair
+    with col1:
+        st.markdown(html1, unsafe_allow_html=True)
     with col2:
-        processed_text2 = []
-        for tag, i1, i2, j1, j2 in opcodes:
-            chunk = text2[j1:j2]
-            if tag == 'equal':
-                processed_text2.append(f'<span>{chunk}</span>')
-            elif tag in ('replace', 'insert'):
-                processed_text2.append(f"<span class='green'>{chunk}</span>")
+        st.markdown(html2, unsafe_allow_html=True)
 
-        html_code = add_html_wrapping(''.join(processed_text2), PROMPT_CSS, 'prompt-block')
-        st.markdown(html_code, unsafe_allow_html=True)
+
+def character_level_compare_and_display(text1, text2, col1, col2):
+    """
+    compare texts and display to streamlit columns
+    :param text1, text2: Texts to compare
+    :param col1, col2: target streamlit columns
+    """
+    display_character_level_diff(character_level_diff(text1, text2), col1, col2)
 
 
 def path_to_keys(diff):
@@ -110,7 +133,7 @@ def _highlight_json_diffs(d, diffs, color_class, change_type):
     :param diffs: list of paths to differing keys/values
     :param color_class: color for highlighting differences
     :param change_type: VALUE_CHANGED to highlight only the value,
-                        KEY_CHANGED to highlight the "subjson" rooted at a key
+                        KEY_CHANGED to highlight the "subjson" rooted at a key (or list item)
     :return: dictionary with HTML formatting applied
     """
     original_dict = copy.deepcopy(d)
@@ -120,10 +143,18 @@ def _highlight_json_diffs(d, diffs, color_class, change_type):
         # follow the keys until the second last level, so we can modify key_to_change
         key_to_change = diff_keys.pop()
         cur_dict = follow_path(original_dict, diff_keys)
+        if isinstance(cur_dict, list):
+            key_to_change = int(key_to_change)
 
         if change_type == _VALUE_CHANGED:
             # only format the value
             cur_dict[key_to_change] = f"<span class='{color_class}'>{cur_dict[key_to_change]}</span>"
+        elif change_type == _KEY_CHANGED and isinstance(cur_dict, list):
+            # list items have no key, format the whole item in place
+            cur_dict[key_to_change] = (
+                f"<span class='{color_class}'>"
+                f"{json.dumps(cur_dict[key_to_change], indent=2, ensure_ascii=False)}"
+                f"</span>")
         elif change_type == _KEY_CHANGED:
             # replace the current <key, value> pair with the formatted version
             cur_dict[f"<span class='{color_class}'>{key_to_change}</span>"] = (
@@ -135,12 +166,12 @@ def _highlight_json_diffs(d, diffs, color_class, change_type):
     return original_dict
 
 
-def json_compare_and_display(dict1, dict2, col1, col2, warn1, warn2):
+def _highlighted_json_texts(dict1, dict2):
     """
-    compare texts and display to streamlit columns
     :param dict1, dict2: JSONs to compare
-    :param col1, col2: target streamlit columns
-    :param warn1, warn2: empty() elements for displaying warning
+    :return:
+        (text1, text2) pretty-printed JSONs with differences highlighted,
+        if either is not a valid JSON, the invalid side is None and the valid side is ''
     """
     # just in case dict1/2 are passed in as strings, convert them if needed
     if not isinstance(dict1, dict):
@@ -149,21 +180,16 @@ def json_compare_and_display(dict1, dict2, col1, col2, warn1, warn2):
         dict2 = load_json_string(dict2)
 
     if dict1 is None or dict2 is None:
-        if dict1 is None:
-            with col1:
-                st.write(dict1)
-                warn1.warning('Previous response does not contain a valid JSON')
-        if dict2 is None:
-            with col2:
-                st.write(dict2)
-                warn2.warning('Current response does not contain a valid JSON')
-        return
+        return (None if dict1 is None else '',
+                None if dict2 is None else '')
 
     diffs = DeepDiff(dict1, dict2, view='tree')
 
     # get paths to differences of each type
-    added = [diff.path() for diff in diffs.get('dictionary_item_added', [])]
-    removed = [diff.path() for diff in diffs.get('dictionary_item_removed', [])]
+    added = ([diff.path() for diff in diffs.get('dictionary_item_added', [])]
+             + [diff.path() for diff in diffs.get('iterable_item_added', [])])
+    removed = ([diff.path() for diff in diffs.get('dictionary_item_removed', [])]
+               + [diff.path() for diff in diffs.get('iterable_item_removed', [])])
     changed = ([diff.path() for diff in diffs.get('values_changed', [])]
                + [diff.path() for diff in diffs.get('type_changes', [])])
 
@@ -174,20 +200,142 @@ def json_compare_and_display(dict1, dict2, col1, col2, warn1, warn2):
     dict2_formatted = _highlight_json_diffs(dict2, added, 'green', _KEY_CHANGED)
     dict2_formatted = _highlight_json_diffs(dict2_formatted, changed, 'green', _VALUE_CHANGED)
 
+    return (json.dumps(dict1_formatted, indent=2, ensure_ascii=False),
+            json.dumps(dict2_formatted, indent=2, ensure_ascii=False))
+
+
+def json_diff(dict1, dict2):
+    """
+    compare JSONs and highlight their differences
+    :param dict1, dict2: JSONs to compare
+    :return:
+        (html1, html2) with differences highlighted,
+        if either is not a valid JSON, the invalid side is None and the valid side is ''
+    """
+    return tuple(add_html_wrapping(text, RESPONSE_CSS, 'response-block') if text else text
+                 for text in _highlighted_json_texts(dict1, dict2))
+
+
+def _collapse_unchanged(text, context, has_diffs):
+    """
+    split text into lines near a highlighted difference and runs of unchanged lines
+
+    :param context: number of unchanged lines kept on each side of a difference,
+                    runs of at most 2 * context unchanged lines are not collapsed
+    :param has_diffs: whether the compared JSONs differ at all
+    :return: list of (is_collapsed, text), consecutive segments alternate
+    """
+    lines = text.split('\n')
+    changed = [i for i, line in enumerate(lines) if _HIGHLIGHT_MARKER in line]
+    # a difference that could not be highlighted must not be hidden
+    if has_diffs and not changed:
+        return [(False, text)]
+    shown = [False] * len(lines)
+    for i in changed:
+        for j in range(max(i - context, 0), min(i + context + 1, len(lines))):
+            shown[j] = True
+
+    segments = []
+    start = 0
+    for i in range(1, len(lines) + 1):
+        if i == len(lines) or shown[i] != shown[start]:
+            # short runs are cheaper to show than a placeholder
+            is_collapsed = not shown[start] and i - start > 2 * context
+            if segments and segments[-1][0] == is_collapsed:
+                segments[-1] = (is_collapsed, f'{segments[-1][1]}\n' + '\n'.join(lines[start:i]))
+            else:
+                segments.append((is_collapsed, '\n'.join(lines[start:i])))
+            start = i
+    return segments
+
+
+def json_diff_collapsed(dict1, dict2, context=_CONTEXT_LINES):
+    """
+    compare JSONs, keeping only differences and a few lines around them expanded,
+    so the rendered size depends on the number of differences, not the JSON size
+
+    :param dict1, dict2: JSONs to compare
+    :param context: number of unchanged lines kept on each side of a difference
+    :return:
+        (segments1, segments2), each a list of (is_collapsed, text),
+        if either is not a valid JSON, the invalid side is None and the valid side is ''
+    """
+    texts = _highlighted_json_texts(dict1, dict2)
+    # highlighting always changes the text, so equal texts mean equal JSONs
+    has_diffs = texts[0] != texts[1]
+    return tuple(_collapse_unchanged(text, context, has_diffs) if text else text
+                 for text in texts)
+
+
+def display_json_diff(html_pair, col1, col2, warn1, warn2):
+    """
+    :param html_pair: result of json_diff
+    :param col1, col2: target streamlit columns
+    :param warn1, warn2: empty() elements for displaying warning
+    """
+    html1, html2 = html_pair
+    if html1 is None or html2 is None:
+        if html1 is None:
+            with col1:
+                st.write(html1)
+                warn1.warning('Previous response does not contain a valid JSON')
+        if html2 is None:
+            with col2:
+                st.write(html2)
+                warn2.warning('Current response does not contain a valid JSON')
+        return
+
     with col1:
-        html_code = add_html_wrapping(
-            json.dumps(dict1_formatted, indent=2, ensure_ascii=False),
-            RESPONSE_CSS,
-            'response-block')
+        st.markdown(html1, unsafe_allow_html=True)
+    with col2:
+        st.markdown(html2, unsafe_allow_html=True)
+
 
-        st.markdown(html_code, unsafe_allow_html=True)
+def _display_segments(segments, key):
+    """
+    collapsed segments are only rendered (and sent to the browser) once their toggle is on
+
+    :param segments: list of (is_collapsed, text)
+    :param key: unique prefix for the toggle widgets
+    """
+    # the styles apply to the whole page, so only send them once
+    styles = RESPONSE_CSS
+    for i, (is_collapsed, text) in enumerate(segments):
+        if is_collapsed:
+            line_count = text.count('\n') + 1
+            label = f"{line_count} unchanged line{'' if line_count == 1 else 's'}"
+            if not st.toggle(label, key=f'{key}-{i}'):
+                continue
+        st.markdown(add_html_wrapping(text, styles, 'response-block'), unsafe_allow_html=True)
+        styles = ''
+
+
+def display_collapsed_json_diff(segments_pair, col1, col2, warn1, warn2, key):
+    """
+    :param segments_pair: result of json_diff_collapsed
+    :param col1, col2: target streamlit columns
+    :param warn1, warn2: empty() elements for displaying warning
+    :param key: unique prefix for the toggle widgets, e.g. the compared versions
+    """
+    segments1, segments2 = segments_pair
+    if segments1 is None or segments2 is None:
+        display_json_diff(segments_pair, col1, col2, warn1, warn2)
+        return
 
+    with col1:
+        _display_segments(segments1, f'{key}-1')
     with col2:
-        html_code = add_html_wrapping(
-            json.dumps(dict2_formatted, indent=2, ensure_ascii=False),
-            RESPONSE_CSS,
-            'response-block')
-        st.markdown(html_code, unsafe_allow_html=True)
+        _display_segments(segments2, f'{key}-2')
+
+
+def json_compare_and_display(dict1, dict2, col1, col2, warn1, warn2):
+    """
+    compare texts and display to streamlit columns
+    :param dict1, dict2: JSONs to compare
+    :param col1, col2: target streamlit columns
+    :param warn1, warn2: empty() elements for displaying warning
+    """
+    display_json_diff(json_diff(dict1, dict2), col1, col2, warn1, warn2)
 
 
 def _count_values(json_obj):
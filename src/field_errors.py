@@ -0,0 +1,95 @@
+from collections import Counter
+
+__all__ = ['FieldErrorAggregator']
+
+# -----------------------------------------------------------------------------
+# private globals
+# -----------------------------------------------------------------------------
+
+# DeepDiff report types counted as missing or wrong values (compared against the right answer)
+_MISSING_TYPES = ('dictionary_item_added', 'iterable_item_added')
+_WRONG_TYPES = ('values_changed', 'type_changes')
+
+
+def _wildcard(keys):
+    """
+    for example, a DeepDiff path could look like: "root['工单信息'][0]['产品名称']"
+    we want list indices grouped together: ['工单信息', 0, '产品名称'] -> 工单信息[*].产品名称
+    """
+    path = ''
+    for key in keys:
+        if isinstance(key, int):
+            path += '[*]'
+        else:
+            path += f'.{key}' if path else str(key)
+    return path
+
+
+def _leaf_keys(json_obj):
+    """keys to every deepest value in json_obj, e.g. [['产品名称'], ['数量']]"""
+    if isinstance(json_obj, dict) and json_obj:
+        items = json_obj.items()
+    elif isinstance(json_obj, list) and json_obj:
+        items = enumerate(json_obj)
+    else:
+        return [[]]
+    return [[key] + keys for key, value in items for keys in _leaf_keys(value)]
+
+
+class FieldErrorAggregator:
+    """
+    running counts of missing and wrong values per field, across many responses
+
+    diffs are consumed one at a time as they arrive, and only the counts are kept,
+    so memory grows with the number of distinct fields, not the number of runs
+
+    every occurrence of a field counts, e.g. if the right answer has 4 工单信息 items,
+    each run can misread 工单信息[*].产品名称 up to 4 times
+    """
+
+    def __init__(self, right_answer):
+        # wildcarded path -> number of occurrences in the right answer
+        self.instances = Counter(_wildcard(keys) for keys in _leaf_keys(right_answer))
+        # wildcarded path -> [missing count, wrong count]
+        self.counts = {}
+        # number of responses consumed, and how many of them were not valid JSONs
+        self.runs = 0
+        self.invalid_runs = 0
+
+    def _count(self, diff, index):
+        """count every deepest value of the right answer under diff as missing/wrong"""
+        keys = diff.path(output_format='list')
+        # t2 is the right answer's side of the difference, missing items are counted per field
+        for sub_keys in _leaf_keys(diff.t2):
+            self.counts.setdefault(_wildcard(keys + sub_keys), [0, 0])[index] += 1
+
+    def add(self, diffs):
+        """
+        :param diffs: result of get_json_diffs(response, right_answer),
+                      None if the response is not a valid JSON
+        """
+        self.runs += 1
+        if diffs is None:
+            self.invalid_runs += 1
+            return
+
+        for report_type in _MISSING_TYPES:
+            for diff in diffs.get(report_type, []):
+                self._count(diff, 0)
+        for report_type in _WRONG_TYPES:
+            for diff in diffs.get(report_type, []):
+                self._count(diff, 1)
+
+    def rates(self):
+        """
+        :return: list of (path, missing rate, wrong rate), most error-prone field first,
+                 rates are fractions of the field's occurrences over the valid JSON runs
+        """
+        valid_runs = self.runs - self.invalid_runs
+        if not valid_runs:
+            return []
+        rows = []
+        for path, (missing, wrong) in self.counts.items():
+            total = valid_runs * max(self.instances[path], 1)
+            rows.append((path, missing / total, wrong / total))
+        return sorted(rows, key=lambda row: row[1] + row[2], reverse=True)
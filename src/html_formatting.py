@@ -1,6 +1,7 @@
 import json
 
-__all__ = ['PROMPT_CSS', 'RESPONSE_CSS', 'add_html_wrapping']
+__all__ = ['PROMPT_CSS', 'RESPONSE_CSS', 'add_html_wrapping', 'field_error_heatmap',
+           'field_agreement_table']
 
 # -----------------------------------------------------------------------------
 # private globals
@@ -45,7 +46,46 @@ RESPONSE_CSS = f"""
 """
 
 
+HEATMAP_CSS = """
+<style>
+.heatmap-block td, .heatmap-block th {
+    padding: 4px 10px;
+    font-family: monospace;
+}
+</style>
+"""
+
+
 def add_html_wrapping(text, styles, classname):
     if isinstance(text, dict):
         text = json.dumps(text, indent=2, ensure_ascii=False)
     return f"{styles}<div class='{classname}'>{text}</div>"
+
+
+def _heatmap_cell(rate, shade=None):
+    """table cell showing rate (0 to 1), shaded red in proportion to shade (defaults to rate)"""
+    shade = rate if shade is None else shade
+    return f"<td style='background-color: rgba(255, 123, 114, {shade:.2f});'>{rate:.0%}</td>"
+
+
+def field_error_heatmap(rates):
+    """
+    :param rates: result of FieldErrorAggregator.rates()
+    :return: HTML table of missing/wrong rates per field
+    """
+    rows = ''.join(f'<tr><td>{path}</td>{_heatmap_cell(missing)}{_heatmap_cell(wrong)}</tr>'
+                   for path, missing, wrong in rates)
+    table = f'<table><tr><th>Field</th><th>Missing</th><th>Wrong</th></tr>{rows}</table>'
+    return add_html_wrapping(table, HEATMAP_CSS, 'heatmap-block')
+
+
+def field_agreement_table(agreement, presence):
+    """
+    :param agreement, presence: {path: rate}, formatted paths as keys, see majority_vote
+    :return: HTML table of agreement and presence per field, shaded by disagreement
+    """
+    rows = ''.join(f'<tr><td>{path}</td>{_heatmap_cell(rate, 1 - rate)}'
+                   f'{_heatmap_cell(presence[path], 1 - rate)}</tr>'
+                   for path, rate in agreement.items())
+    table = f'<table><tr><th>Field</th><th>Agreement</th><th>Present in</th></tr>{rows}</table>'
+    return add_html_wrapping(table, HEATMAP_CSS, 'heatmap-block')
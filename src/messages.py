@@ -1,8 +1,13 @@
 import json
 
-__all__ = ['json_analysis_prompt']
+__all__ = ['json_analysis_prompt', 'prompt_refinement_prompt']
 
 ANALYSIS_RESPONSE_START = '###analysis：'
+# rewritten prompts are wrapped in these, since the prompt itself can contain ``` blocks
+REFINED_PROMPT_START = '<prompt>'
+REFINED_PROMPT_END = '</prompt>'
+# most error-prone fields to include in the analysis prompt
+_MAX_FIELD_ERRORS = 10
 
 
 def _format_diffs(diffs):
@@ -25,7 +30,19 @@ def _format_diffs(diffs):
     return f'{missing_prompt}\n{wrong_prompt}'
 
 
-def json_analysis_prompt(prompt, accuracy, diffs, response, is_first_prompt):
+def _format_field_errors(field_errors):
+    """
+    format per-field error rates across previous runs for model prompt
+    """
+    # e.g. 工单信息[*].产品名称：漏掉0%，错误40%
+    lines = [f'{path}：漏掉{missing:.0%}，错误{wrong:.0%}'
+             for path, missing, wrong in field_errors.rates()[:_MAX_FIELD_ERRORS]]
+    return (f'在{field_errors.runs - field_errors.invalid_runs}次有效解析中，最常出错的字段如下。\n'
+            + '\n'.join(lines))
+
+
+def json_analysis_prompt(prompt, accuracy, diffs, response, is_first_prompt,
+                         field_errors=None):
     """
     formats a prompt to analyze current response vs. right answer
 
@@ -34,6 +51,7 @@ def json_analysis_prompt(prompt, accuracy, diffs, response, is_first_prompt):
     :param diffs: DeepDiff diffs
     :param response: model response, dict if contains valid json, else string
     :param is_first_prompt: True if analyzing first prompt, False if analyzing new prompt versions
+    :param field_errors: FieldErrorAggregator over previous runs, included if there is more than one run
     """
     if is_first_prompt:
         prompt_start = ""
@@ -52,6 +70,9 @@ def json_analysis_prompt(prompt, accuracy, diffs, response, is_first_prompt):
         else:
             analysis = "你的输出不是JSON格式。"
 
+    if field_errors is not None and field_errors.runs > 1 and field_errors.counts:
+        analysis += f"\n{_format_field_errors(field_errors)}\n"
+
     task = ('请综合考量核心任务、提示词、输出、错误详情，' if is_first_prompt
             else '请综合考量核心任务、提示词的变化带来的错误详情的变化，')
 
@@ -69,3 +90,23 @@ def json_analysis_prompt(prompt, accuracy, diffs, response, is_first_prompt):
         f"{task}分析提示词可以改进的方向，输出调整提示词的建议"
     )
     return analyze_json_prompt
+
+
+def prompt_refinement_prompt(prompt, analysis):
+    """
+    formats a prompt asking the model to rewrite prompt following its own analysis
+
+    :param prompt: prompt to improve
+    :param analysis: model response to json_analysis_prompt for this prompt
+    """
+    refine_prompt = (
+        f"# 你作为assistant的核心任务\n"
+        f"根据对提示词的分析和建议改写提示词，使从附件中解析出的JSON更准确。\n\n"
+        f"# 提示词\n"
+        f"{prompt}\n\n"
+        f"# 分析和建议\n"
+        f"{analysis}\n\n"
+        f"# 当前任务\n"
+        f"输出改写后的完整提示词，以{REFINED_PROMPT_START}开头，以{REFINED_PROMPT_END}结尾，不要输出其他内容"
+    )
+    return refine_prompt
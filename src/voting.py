@@ -0,0 +1,94 @@
+from collections import Counter
+import json
+
+__all__ = ['format_path', 'majority_vote']
+
+
+def _flatten(json_obj, path=()):
+    """
+    map every deepest value in json_obj to its path, e.g. ('工单信息', 0, '产品名称'),
+    empty dicts/lists count as values
+    """
+    if isinstance(json_obj, dict) and json_obj:
+        items = json_obj.items()
+    elif isinstance(json_obj, list) and json_obj:
+        items = enumerate(json_obj)
+    else:
+        return {path: json_obj}
+
+    flat = {}
+    for key, value in items:
+        flat.update(_flatten(value, path + (key,)))
+    return flat
+
+
+def _set_path(root, path, value):
+    """set value at path in root, list indices are kept as dict keys until _to_lists"""
+    node = root
+    for key in path[:-1]:
+        node = node.setdefault(key, {})
+    node[path[-1]] = value
+
+
+def _to_lists(node):
+    """convert dicts keyed by list indices back into lists (dropping indices that lost the vote)"""
+    if not isinstance(node, dict) or not node:
+        return node
+    if all(isinstance(key, int) for key in node):
+        return [_to_lists(node[key]) for key in sorted(node)]
+    return {key: _to_lists(value) for key, value in node.items()}
+
+
+def format_path(path):
+    """('工单信息', 0, '产品名称') -> 工单信息[0].产品名称"""
+    formatted = ''
+    for key in path:
+        if isinstance(key, int):
+            formatted += f'[{key}]'
+        else:
+            formatted += f'.{key}' if formatted else str(key)
+    return formatted
+
+
+def majority_vote(samples):
+    """
+    align sampled JSONs by path and take the most common value of each field
+
+    a field is kept if it appears in more than half of the valid samples,
+    list items are aligned by index
+
+    the most common value wins even without a majority (plurality), and among tied values
+    the one from the earliest sample wins, such fields show up with a low agreement
+
+    :param samples: list of responses, dict if contains valid json, else string
+    :return:
+        (None, {}, {}) if no sample is a valid JSON,
+        (voted dict, agreement, presence) otherwise, where for every path seen in any sample,
+        agreement is the fraction of valid samples agreeing with the vote
+        (on the value if the field is kept, on leaving it out otherwise),
+        and presence is the fraction of valid samples containing the field
+    """
+    valid = [sample for sample in samples if isinstance(sample, dict)]
+    if not valid:
+        return None, {}, {}
+
+    # path -> Counter of values, values are dumped so that dicts/lists are hashable
+    votes = {}
+    for sample in valid:
+        for path, value in _flatten(sample).items():
+            votes.setdefault(path, Counter())[json.dumps(value, ensure_ascii=False)] += 1
+
+    voted = {}
+    agreement = {}
+    presence = {}
+    for path, counter in votes.items():
+        present = sum(counter.values())
+        presence[path] = present / len(valid)
+        if present * 2 <= len(valid):
+            agreement[path] = 1 - presence[path]
+            continue
+        value, count = counter.most_common(1)[0]
+        agreement[path] = count / len(valid)
+        if path:
+            _set_path(voted, path, json.loads(value))
+    return _to_lists(voted), agreement, presence